@@ -0,0 +1,103 @@
+"""partition Lessons by hash of telegram_id
+
+Revision ID: 3f1c2a9b7d04
+Revises:
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+import os
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c2a9b7d04'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+LESSONS_PARTITIONS = max(int(os.getenv('LESSONS_PARTITIONS', '8')), 1)
+
+
+def lessons_relkind() -> str:
+    # 'p' — секционированная таблица, 'r' — обычная
+    return op.get_bind().scalar(sa.text("""SELECT relkind FROM pg_class WHERE oid = '"Lessons"'::regclass"""))
+
+
+def lessons_sequence() -> str:
+    sequence = op.get_bind().scalar(sa.text("""SELECT pg_get_serial_sequence('"Lessons"', 'id')"""))
+    if sequence is None:
+        raise RuntimeError('Lessons.id is not backed by an owned sequence, the table layout is not supported')
+    return sequence
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # база, созданная через /api/setup_database после перехода на секции, уже секционирована
+    if lessons_relkind() == 'p':
+        return
+    sequence = lessons_sequence()
+
+    op.execute('ALTER TABLE "Lessons" RENAME TO "Lessons_old"')
+    op.execute('ALTER TABLE "Lessons_old" RENAME CONSTRAINT "Lessons_pkey" TO "Lessons_old_pkey"')
+    op.execute('ALTER TABLE "Lessons_old" DROP CONSTRAINT IF EXISTS "Lessons_id_key"')
+
+    op.execute(
+        f'''
+        CREATE TABLE "Lessons" (
+            id INTEGER NOT NULL DEFAULT nextval('{sequence}'),
+            title VARCHAR(32) NOT NULL,
+            score INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL REFERENCES "Students" (telegram_id) ON DELETE CASCADE,
+            PRIMARY KEY (id, telegram_id)
+        ) PARTITION BY HASH (telegram_id)
+        '''
+    )
+    for remainder in range(LESSONS_PARTITIONS):
+        op.execute(
+            f'CREATE TABLE "Lessons_p{remainder}" PARTITION OF "Lessons" '
+            f'FOR VALUES WITH (MODULUS {LESSONS_PARTITIONS}, REMAINDER {remainder})'
+        )
+    op.create_index('ix_Lessons_telegram_id', 'Lessons', ['telegram_id'])
+
+    # уроки без ученика не попадают ни в одну секцию и при каскадном удалении всё равно не нужны
+    op.execute(
+        'INSERT INTO "Lessons" (id, title, score, telegram_id) '
+        'SELECT id, title, score, telegram_id FROM "Lessons_old" WHERE telegram_id IS NOT NULL'
+    )
+    op.execute(f'ALTER SEQUENCE {sequence} OWNED BY "Lessons".id')
+    op.drop_table('Lessons_old')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if lessons_relkind() != 'p':
+        return
+    sequence = lessons_sequence()
+
+    op.execute('ALTER TABLE "Lessons" RENAME TO "Lessons_partitioned"')
+    op.execute('ALTER TABLE "Lessons_partitioned" RENAME CONSTRAINT "Lessons_pkey" TO "Lessons_partitioned_pkey"')
+    op.drop_index('ix_Lessons_telegram_id', table_name='Lessons_partitioned')
+
+    # последовательность переносится на новую таблицу, а не создаётся заново,
+    # иначе она получит имя "Lessons_id_seq1" и следующий upgrade её не найдёт
+    op.execute(
+        f'''
+        CREATE TABLE "Lessons" (
+            id INTEGER NOT NULL DEFAULT nextval('{sequence}'),
+            title VARCHAR(32) NOT NULL,
+            score INTEGER NOT NULL,
+            telegram_id INTEGER REFERENCES "Students" (telegram_id) ON DELETE CASCADE,
+            PRIMARY KEY (id),
+            UNIQUE (id)
+        )
+        '''
+    )
+    op.execute(
+        'INSERT INTO "Lessons" (id, title, score, telegram_id) '
+        'SELECT id, title, score, telegram_id FROM "Lessons_partitioned"'
+    )
+    op.execute(f'ALTER SEQUENCE {sequence} OWNED BY "Lessons".id')
+    op.drop_table('Lessons_partitioned')
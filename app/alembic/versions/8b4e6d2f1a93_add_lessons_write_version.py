@@ -0,0 +1,29 @@
+"""add write_version to Lessons
+
+Revision ID: 8b4e6d2f1a93
+Revises: 3f1c2a9b7d04
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b4e6d2f1a93'
+down_revision: Union[str, Sequence[str], None] = '3f1c2a9b7d04'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # в базе, созданной через /api/setup_database, колонка уже есть
+    op.execute('ALTER TABLE "Lessons" ADD COLUMN IF NOT EXISTS write_version BIGINT')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('Lessons', 'write_version')
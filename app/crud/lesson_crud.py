@@ -1,8 +1,8 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, text
 
 from models import LessonModel, StudentModel
-from schemas import LessonCreate
+from schemas import LessonCreate, LessonUpdate
 from exceptions import StudentNotFoundException
 
 async def create_lesson(lesson: LessonCreate, session: AsyncSession) -> LessonModel:
@@ -28,8 +28,9 @@ async def get_student_lessons(telegram_id: int, session: AsyncSession) -> list[L
     return result.scalars().all()
 
 
-async def delete_lesson(lesson_id: int, session: AsyncSession) -> bool:
-    result = await session.execute(select(LessonModel).where(LessonModel.id == lesson_id))
+async def delete_lesson(lesson_id: int, telegram_id: int, session: AsyncSession) -> bool:
+    # telegram_id в условии нужен, чтобы запрос попадал только в одну секцию таблицы
+    result = await session.execute(select(LessonModel).where(LessonModel.telegram_id == telegram_id, LessonModel.id == lesson_id))
     lesson = result.scalar_one_or_none()
     if not lesson:
         return False
@@ -39,15 +40,62 @@ async def delete_lesson(lesson_id: int, session: AsyncSession) -> bool:
     return True
 
 
-async def update_lesson(lesson_data: LessonCreate, session: AsyncSession) -> LessonModel:
-    result = await session.execute(select(LessonModel).where(LessonModel.id == lesson_data.id))
+async def update_lesson(lesson_data: LessonUpdate, session: AsyncSession) -> LessonModel:
+    result = await session.execute(select(LessonModel).where(LessonModel.telegram_id == lesson_data.telegram_id, LessonModel.id == lesson_data.id))
     lesson = result.scalar_one_or_none()
     if not lesson:
         return False
     
-    for field, value in lesson_data.items():
+    for field, value in lesson_data.model_dump().items():
         setattr(lesson, field, value)
     
     await session.commit()
     await session.refresh(lesson)
-    return lesson
\ No newline at end of file
+    return lesson
+
+
+async def apply_lesson_writes(writes: list[tuple[int, LessonCreate | LessonUpdate]], session: AsyncSession) -> int:
+    '''
+        Применение пачки записей баллов в одной транзакции.
+        Каждая запись передаётся вместе с версией — возрастающим номером записи в потоке.
+        Запись с id перезаписывает урок, запись без id обновляет урок ученика с тем же названием
+        или создаёт новый. Запись не старше уже применённой к уроку пропускается, поэтому
+        повторная доставка старых записей не затирает более новые баллы.
+        Записи несуществующих учеников пропускаются
+    '''
+    telegram_ids = sorted({write.telegram_id for _, write in writes})
+    # блокировки учеников упорядочивают пачки разных обработчиков с общими учениками
+    await session.execute(
+        text('SELECT pg_advisory_xact_lock(telegram_id) FROM (SELECT unnest(CAST(:ids AS bigint[])) AS telegram_id ORDER BY 1) AS ids'),
+        {'ids': telegram_ids},
+    )
+    students = await session.execute(select(StudentModel.telegram_id).where(StudentModel.telegram_id.in_(telegram_ids)))
+    existing_students = set(students.scalars().all())
+
+    lessons = await session.execute(select(LessonModel).where(LessonModel.telegram_id.in_(existing_students)))
+    by_id = {}
+    by_title = {}
+    for lesson in lessons.scalars().all():
+        by_id[lesson.id] = lesson
+        by_title[(lesson.telegram_id, lesson.title)] = lesson
+
+    applied = 0
+    for version, write in writes:
+        if write.telegram_id not in existing_students:
+            continue
+        lesson = by_id.get(write.id) if isinstance(write, LessonUpdate) else by_title.get((write.telegram_id, write.title))
+        if lesson is None:
+            if isinstance(write, LessonUpdate):
+                continue
+            lesson = LessonModel(telegram_id=write.telegram_id)
+            session.add(lesson)
+        elif lesson.write_version is not None and lesson.write_version >= version:
+            continue
+        lesson.title = write.title
+        lesson.score = write.score
+        lesson.write_version = version
+        by_title[(write.telegram_id, write.title)] = lesson
+        applied += 1
+
+    await session.commit()
+    return applied
\ No newline at end of file
@@ -28,6 +28,12 @@ async def get_student(telegram_id: int, session: AsyncSession) -> StudentModel |
     return student
 
 
+async def check_student_exists(telegram_id: int, session: AsyncSession) -> None:
+    result = await session.execute(select(StudentModel.id).where(StudentModel.telegram_id == telegram_id))
+    if result.scalar_one_or_none() is None:
+        raise StudentNotFoundException()
+
+
 async def delete_student(telegram_id: int, session: AsyncSession) -> bool:
     result = await session.execute(select(StudentModel).where(StudentModel.telegram_id == telegram_id))
     student = result.scalar_one_or_none()
@@ -3,13 +3,15 @@ from logging import getLogger, DEBUG
 import uvicorn
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, Header, HTTPException
 
 from crud.lesson_crud import create_lesson, delete_lesson, get_lessons, get_student_lessons, update_lesson
-from crud.student_crud import create_student, delete_student, get_student, update_student
+from crud.student_crud import check_student_exists, create_student, delete_student, get_student, update_student
 from exceptions import StudentAlreadyExistsException, StudentNotFoundException
-from schemas import LessonCreate, StudentCreate
+from schemas import LessonCreate, LessonUpdate, StudentCreate
 from database import get_db, setup_database
+from profiling import PROFILING_HEADER, SLOW_QUERY_THRESHOLD_MS, check_profiling_token, setup_profiling, slow_queries
+from write_behind import WRITE_BEHIND_ENABLED, enqueue_lesson_write, merge_pending_lessons
 
 logging.basicConfig(
     level=DEBUG,
@@ -25,6 +27,7 @@ app = FastAPI(
     title='Сервис по ведению баллов по экзаменам',
     docs_url='/api/docs'
     )
+setup_profiling(app)
 
 
 @app.post('/api/setup_database', tags=['Настройка'], summary='Создание базы данных', description='Эндпоинт для создания или перезаписи базы данных')
@@ -123,6 +126,8 @@ async def get_students_lessons_url(telegram_id: int, session: AsyncSession = Dep
     '''
     try:
         lessons = await get_student_lessons(telegram_id, session)
+        if WRITE_BEHIND_ENABLED:
+            return await merge_pending_lessons(telegram_id, lessons)
         return lessons
     except Exception as e:
         logger.error(f'Ошибка при получении данных: {e}')
@@ -134,6 +139,9 @@ async def create_student_url(lesson_data: LessonCreate, session: AsyncSession =
         Создание записи предмета
     '''
     try:
+        if WRITE_BEHIND_ENABLED:
+            await check_student_exists(lesson_data.telegram_id, session)
+            return await enqueue_lesson_write(lesson_data)
         lesson = await create_lesson(lesson_data, session)
         return lesson
     except StudentNotFoundException as e:
@@ -143,13 +151,13 @@ async def create_student_url(lesson_data: LessonCreate, session: AsyncSession =
         logger.error(f'Ошибка при создании предмета: {e}')
         return None
     
-@app.delete('/api/lessons/{lesson_id}', tags=['Предметы'], summary='Удаление предмета', description='Эндпоинт для удаления предмета')
-async def delete_lesson_url(lesson_id: int, session: AsyncSession = Depends(get_db)):
+@app.delete('/api/lessons/{telegram_id}/{lesson_id}', tags=['Предметы'], summary='Удаление предмета', description='Эндпоинт для удаления предмета ученика')
+async def delete_lesson_url(telegram_id: int, lesson_id: int, session: AsyncSession = Depends(get_db)):
     '''
         Удаление предмета
     '''
     try:
-        result = await delete_lesson(lesson_id, session)
+        result = await delete_lesson(lesson_id, telegram_id, session)
         return 'Предмет успешно удалён' if result else 'Не удалось удалить предмет'
     except StudentNotFoundException as e:
         logger.error('Не удалось удалить предмет. Предмет не найден')
@@ -159,11 +167,14 @@ async def delete_lesson_url(lesson_id: int, session: AsyncSession = Depends(get_
         return None
 
 @app.put('/api/lessons', tags=['Предметы'], summary='Изменение информации о предмете', description='Эндпоинт для изменения информации о предмете')
-async def update_lesson_url(lesson_data: LessonCreate, session: AsyncSession = Depends(get_db)):
+async def update_lesson_url(lesson_data: LessonUpdate, session: AsyncSession = Depends(get_db)):
     '''
         Изменение информации о предмете
     '''
     try:
+        if WRITE_BEHIND_ENABLED:
+            await check_student_exists(lesson_data.telegram_id, session)
+            return await enqueue_lesson_write(lesson_data)
         result = await update_lesson(lesson_data, session)
         return result
     except StudentNotFoundException as e:
@@ -174,6 +185,18 @@ async def update_lesson_url(lesson_data: LessonCreate, session: AsyncSession = D
         return None
 
 
+if SLOW_QUERY_THRESHOLD_MS > 0:
+    @app.get('/api/profiling/slow_queries', tags=['Настройка'], summary='Журнал медленных запросов', description='Эндпоинт для получения последних медленных SQL-запросов с их планами выполнения. Требует заголовок X-Profile с PROFILING_TOKEN')
+    async def get_slow_queries_url(token: str | None = Header(default=None, alias=PROFILING_HEADER.decode())):
+        '''
+            Получение журнала медленных запросов
+        '''
+        # планы запросов содержат значения параметров, то есть данные учеников
+        if not check_profiling_token(token):
+            raise HTTPException(status_code=403, detail='Invalid profiling token')
+        return list(slow_queries)
+
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
@@ -1,9 +1,15 @@
+import os
+
 from database import Base
 
-from sqlalchemy import Boolean, Column, DateTime, Enum, Float, ForeignKey, Integer, String, func
+from sqlalchemy import DDL, BigInteger, Boolean, Column, DateTime, Enum, Float, ForeignKey, Integer, String, event, func
 from sqlalchemy.orm import relationship
 
 
+# Количество hash-секций таблицы Lessons по telegram_id
+LESSONS_PARTITIONS = max(int(os.getenv('LESSONS_PARTITIONS', '8')), 1)
+
+
 class StudentModel(Base):
     '''
         Модель ученика
@@ -20,13 +26,31 @@ class StudentModel(Base):
 
 class LessonModel(Base):
     '''
-        Модель для урока
+        Модель для урока. Таблица секционирована по хешу telegram_id,
+        поэтому telegram_id входит в первичный ключ
     '''
     __tablename__ = 'Lessons'
+    __table_args__ = {'postgresql_partition_by': 'HASH (telegram_id)'}
 
-    id = Column(Integer, primary_key=True, unique=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String(32), nullable=False)
     score = Column(Integer, nullable=False)
-    telegram_id = Column(Integer, ForeignKey('Students.telegram_id', ondelete="CASCADE"))  
+    # версия последней применённой отложенной записи из Redis Stream, см. write_behind.py
+    write_version = Column(BigInteger, nullable=True)
+    telegram_id = Column(Integer, ForeignKey('Students.telegram_id', ondelete="CASCADE"), primary_key=True, index=True)
+    student = relationship('StudentModel', back_populates='lessons', lazy='selectin')
+
+
+def lessons_partitions_ddl(partitions: int) -> list[str]:
+    '''
+        DDL для создания секций таблицы Lessons
+    '''
+    return [
+        f'CREATE TABLE "Lessons_p{remainder}" PARTITION OF "Lessons" '
+        f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})'
+        for remainder in range(partitions)
+    ]
+
 
-    student = relationship('StudentModel', back_populates='lessons', lazy='selectin')
\ No newline at end of file
+for statement in lessons_partitions_ddl(LESSONS_PARTITIONS):
+    event.listen(LessonModel.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
@@ -0,0 +1,167 @@
+import os
+import re
+import secrets
+import time
+import asyncio
+from collections import deque
+from contextvars import ContextVar
+from logging import getLogger
+
+from sqlalchemy import event
+
+from database import engine
+
+
+logger = getLogger(__name__)
+
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '0') == '1'
+PROFILING_HEADER = os.getenv('PROFILING_HEADER', 'X-Profile').lower().encode()
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN')
+PROFILING_DIR = os.getenv('PROFILING_DIR', '/tmp/profiles')
+PROFILING_INTERVAL = float(os.getenv('PROFILING_INTERVAL', '0.001'))
+
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '0'))
+SLOW_QUERY_HISTORY = int(os.getenv('SLOW_QUERY_HISTORY', '100'))
+# EXPLAIN ANALYZE повторно исполняет запрос, поэтому один и тот же запрос разбирается не чаще раза в этот интервал
+SLOW_QUERY_EXPLAIN_COOLDOWN = float(os.getenv('SLOW_QUERY_EXPLAIN_COOLDOWN', '300'))
+SLOW_QUERY_MAX_EXPLAINS = int(os.getenv('SLOW_QUERY_MAX_EXPLAINS', '2'))
+
+# scope текущего запроса, имя маршрута достаётся из него лениво — роутинг происходит уже после middleware
+current_scope: ContextVar[dict | None] = ContextVar('current_scope', default=None)
+slow_queries: deque = deque(maxlen=SLOW_QUERY_HISTORY)
+_explaining: set[str] = set()
+_last_explained: dict[str, float] = {}
+_explain_tasks: set[asyncio.Task] = set()
+
+
+def check_profiling_token(token: str | None) -> bool:
+    '''
+        Проверка токена доступа к данным профилирования
+    '''
+    return bool(PROFILING_TOKEN) and token is not None and secrets.compare_digest(token, PROFILING_TOKEN)
+
+
+def get_route_name(scope: dict | None) -> str:
+    '''
+        Получение имени маршрута из scope запроса
+    '''
+    if scope is None:
+        return '-'
+    endpoint = scope.get('endpoint')
+    if endpoint is not None:
+        return endpoint.__name__
+    return scope.get('path', '-')
+
+
+class ProfilingMiddleware:
+    '''
+        ASGI middleware: запоминает scope запроса для журнала медленных запросов
+        и по заголовку X-Profile снимает профиль запроса семплирующим профилировщиком
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        token = current_scope.set(scope)
+        try:
+            header = dict(scope['headers']).get(PROFILING_HEADER) if PROFILING_ENABLED else None
+            # без PROFILING_TOKEN профилирование не запускается: каждый профиль — это работа профилировщика и файл на диске
+            if header is None or not check_profiling_token(header.decode()):
+                return await self.app(scope, receive, send)
+            await self._profile(scope, receive, send)
+        finally:
+            current_scope.reset(token)
+
+    async def _profile(self, scope, receive, send):
+        from pyinstrument import Profiler
+
+        profiler = Profiler(interval=PROFILING_INTERVAL, async_mode='enabled')
+        # случайный суффикс, чтобы профили одного маршрута за одну миллисекунду не перезаписывали друг друга
+        started = f'{int(time.time() * 1000)}-{secrets.token_hex(4)}'
+        # к началу ответа роутинг уже выполнен и имя маршрута известно
+        def path():
+            # для запросов без маршрута имя — это путь запроса, который нельзя подставлять в путь к файлу
+            route = re.sub(r'[^\w.-]', '_', get_route_name(scope))
+            return os.path.join(PROFILING_DIR, f'{route}-{started}.html')
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [(b'x-profile-file', path().encode())]
+            await send(message)
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.stop()
+            os.makedirs(PROFILING_DIR, exist_ok=True)
+            with open(path(), 'w') as file:
+                file.write(profiler.output_html())
+            logger.info(f'Профиль запроса {get_route_name(scope)} сохранён в {path()}')
+
+
+async def explain_query(statement: str, parameters, route: str, duration_ms: float):
+    '''
+        Получение плана медленного запроса отдельным соединением
+    '''
+    # ANALYZE исполняет запрос, поэтому для изменяющих запросов снимаем только план
+    is_select = statement.lstrip().upper().startswith('SELECT')
+    prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if is_select else 'EXPLAIN '
+    try:
+        async with engine.connect() as conn:
+            result = await conn.exec_driver_sql(prefix + statement, parameters)
+            plan = '\n'.join(row[0] for row in result)
+            await conn.rollback()
+        slow_queries.append({
+            'route': route,
+            'duration_ms': round(duration_ms, 2),
+            'statement': statement,
+            'plan': plan,
+        })
+        logger.warning(f'Медленный запрос в {route} ({duration_ms:.2f} мс):\n{statement}\n{plan}')
+    except Exception as e:
+        logger.error(f'Не удалось получить план запроса: {e}')
+    finally:
+        _explaining.discard(statement)
+
+
+# время начала хранится в контексте выполнения: он живёт один запрос,
+# поэтому упавшие запросы ничего не оставляют на соединении из пула
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start_time = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - context._query_start_time) * 1000
+    if duration_ms < SLOW_QUERY_THRESHOLD_MS or statement.startswith('EXPLAIN'):
+        return
+    route = get_route_name(current_scope.get())
+    now = time.monotonic()
+    if (
+        executemany
+        or statement in _explaining
+        or len(_explaining) >= SLOW_QUERY_MAX_EXPLAINS
+        or now - _last_explained.get(statement, float('-inf')) < SLOW_QUERY_EXPLAIN_COOLDOWN
+    ):
+        logger.warning(f'Медленный запрос в {route} ({duration_ms:.2f} мс): {statement}')
+        return
+    _explaining.add(statement)
+    _last_explained[statement] = now
+    task = asyncio.get_running_loop().create_task(explain_query(statement, parameters, route, duration_ms))
+    _explain_tasks.add(task)
+    task.add_done_callback(_explain_tasks.discard)
+
+
+def setup_profiling(app):
+    '''
+        Подключение профилирования запросов и журнала медленных SQL-запросов.
+        Если оба механизма выключены, ничего не регистрируется
+    '''
+    if SLOW_QUERY_THRESHOLD_MS > 0:
+        event.listen(engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine.sync_engine, 'after_cursor_execute', after_cursor_execute)
+    if PROFILING_ENABLED or SLOW_QUERY_THRESHOLD_MS > 0:
+        app.add_middleware(ProfilingMiddleware)
@@ -10,7 +10,10 @@ class StudentCreate(StudentBase):
 
 class LessonBase(BaseModel):
     title: str = Field(max_length=32)
-    score: int = Field()
+    score: int = Field(ge=0, le=100)
 
 class LessonCreate(LessonBase):
-    telegram_id: int = Field()
\ No newline at end of file
+    telegram_id: int = Field()
+
+class LessonUpdate(LessonCreate):
+    id: int = Field()
\ No newline at end of file
@@ -0,0 +1,270 @@
+import os
+import json
+import socket
+import time
+import asyncio
+import logging
+from logging import getLogger
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError, ResponseError
+
+from crud.lesson_crud import apply_lesson_writes
+from database import new_session
+from schemas import LessonCreate, LessonUpdate
+
+
+logger = getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', '0') == '1'
+LESSONS_STREAM = os.getenv('LESSONS_STREAM', 'lessons:writes')
+LESSONS_GROUP = os.getenv('LESSONS_GROUP', 'lessons-flush')
+WRITE_BEHIND_BATCH = int(os.getenv('WRITE_BEHIND_BATCH', '500'))
+WRITE_BEHIND_BLOCK_MS = int(os.getenv('WRITE_BEHIND_BLOCK_MS', '1000'))
+# через сколько миллисекунд неподтверждённые записи упавшего обработчика забираются другим
+WRITE_BEHIND_CLAIM_IDLE_MS = int(os.getenv('WRITE_BEHIND_CLAIM_IDLE_MS', '30000'))
+# после стольких неудачных доставок запись считается испорченной и снимается с очереди
+WRITE_BEHIND_MAX_DELIVERIES = int(os.getenv('WRITE_BEHIND_MAX_DELIVERIES', '5'))
+
+redis_client = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'), decode_responses=True)
+
+# Добавляет запись в поток и в хеш ожидающих записей ученика за одну атомарную операцию
+ENQUEUE_SCRIPT = redis_client.register_script(
+    '''
+    local entry_id = redis.call('XADD', KEYS[1], '*', 'lesson', ARGV[2])
+    local value = cjson.decode(ARGV[2])
+    value['entry_id'] = entry_id
+    redis.call('HSET', KEYS[2], ARGV[1], cjson.encode(value))
+    return entry_id
+    '''
+)
+
+# Удаляет ожидающую запись, только если она не была перезаписана более новой
+DELETE_PENDING_SCRIPT = redis_client.register_script(
+    '''
+    local value = redis.call('HGET', KEYS[1], ARGV[1])
+    if value and cjson.decode(value)['entry_id'] == ARGV[2] then
+        return redis.call('HDEL', KEYS[1], ARGV[1])
+    end
+    return 0
+    '''
+)
+
+
+def pending_key(telegram_id: int) -> str:
+    return f'lessons:pending:{telegram_id}'
+
+
+def entry_order(entry_id: str) -> tuple[int, int]:
+    milliseconds, sequence = entry_id.split('-')
+    return int(milliseconds), int(sequence)
+
+
+def entry_version(entry_id: str) -> int:
+    '''
+        Версия записи для LessonModel.write_version: возрастает вместе с id записи в потоке
+    '''
+    milliseconds, sequence = entry_order(entry_id)
+    return milliseconds * 1_000_000 + sequence
+
+
+def pending_field(lesson: LessonCreate | LessonUpdate) -> str:
+    if isinstance(lesson, LessonUpdate):
+        return f'id:{lesson.id}'
+    return f'title:{lesson.title}'
+
+
+async def enqueue_lesson_write(lesson: LessonCreate | LessonUpdate) -> dict:
+    '''
+        Постановка записи баллов в очередь. Запись добавляется в поток и в хеш
+        ожидающих записей ученика, чтобы чтение видело её до сброса в базу
+    '''
+    payload = lesson.model_dump()
+    await ENQUEUE_SCRIPT(keys=[LESSONS_STREAM, pending_key(lesson.telegram_id)], args=[pending_field(lesson), json.dumps(payload)])
+    return {**payload, 'id': payload.get('id'), 'pending': True}
+
+
+async def merge_pending_lessons(telegram_id: int, lessons: list) -> list[dict]:
+    '''
+        Наложение ожидающих записей ученика на уроки из базы
+    '''
+    pending = await redis_client.hgetall(pending_key(telegram_id))
+    result = [
+        {'id': lesson.id, 'title': lesson.title, 'score': lesson.score, 'telegram_id': lesson.telegram_id}
+        for lesson in lessons
+    ]
+    if not pending:
+        return result
+
+    by_id = {lesson['id']: lesson for lesson in result}
+    by_title = {lesson['title']: lesson for lesson in result}
+    for write in sorted(map(json.loads, pending.values()), key=lambda write: entry_order(write['entry_id'])):
+        lesson = by_id.get(write['id']) if write.get('id') is not None else by_title.get(write['title'])
+        if lesson is None:
+            if write.get('id') is not None:
+                continue
+            lesson = {'id': None, 'telegram_id': telegram_id}
+            result.append(lesson)
+            by_title[write['title']] = lesson
+        lesson.update(title=write['title'], score=write['score'], pending=True)
+    return result
+
+
+def coalesce(entries: list[tuple[str, dict]]) -> dict[tuple[int, str], tuple[str, LessonCreate | LessonUpdate]]:
+    '''
+        Склейка записей пачки: для каждого урока ученика остаётся только последняя
+    '''
+    writes = {}
+    for entry_id, fields in entries:
+        payload = json.loads(fields['lesson'])
+        lesson = LessonUpdate(**payload) if payload.get('id') is not None else LessonCreate(**payload)
+        writes[(lesson.telegram_id, pending_field(lesson))] = (entry_id, lesson)
+    return writes
+
+
+async def apply_entries(entries: list[tuple[str, dict]]):
+    '''
+        Сброс записей в базу одной транзакцией и подтверждение их в потоке.
+        Подтверждение идёт только после коммита, поэтому доставка — как минимум однократная
+    '''
+    writes = coalesce(entries)
+    async with new_session() as session:
+        applied = await apply_lesson_writes(
+            [(entry_version(entry_id), lesson) for entry_id, lesson in writes.values()], session
+        )
+
+    entry_ids = [entry_id for entry_id, _ in entries]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.xack(LESSONS_STREAM, LESSONS_GROUP, *entry_ids)
+        pipe.xdel(LESSONS_STREAM, *entry_ids)
+        for (telegram_id, field), (entry_id, _) in writes.items():
+            await DELETE_PENDING_SCRIPT(keys=[pending_key(telegram_id)], args=[field, entry_id], client=pipe)
+        await pipe.execute()
+    return applied
+
+
+async def dead_letter(entry_id: str, fields: dict):
+    '''
+        Снятие испорченной записи с очереди: подтверждение, удаление из потока
+        и из хеша ожидающих записей, чтобы чтение не показывало несохранённые баллы
+    '''
+    logger.error(f'Запись {entry_id} не удалось сбросить за {WRITE_BEHIND_MAX_DELIVERIES} попыток, она отброшена: {fields}')
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.xack(LESSONS_STREAM, LESSONS_GROUP, entry_id)
+        pipe.xdel(LESSONS_STREAM, entry_id)
+        try:
+            lesson = next(iter(coalesce([(entry_id, fields)]).values()))[1]
+            await DELETE_PENDING_SCRIPT(
+                keys=[pending_key(lesson.telegram_id)], args=[pending_field(lesson), entry_id], client=pipe
+            )
+        except Exception:
+            # запись не разбирается, значит, в хеш ожидающих записей она и не попала
+            pass
+        await pipe.execute()
+
+
+async def flush(entries: list[tuple[str, dict]]):
+    '''
+        Сброс пачки записей. Если пачка не применяется целиком, записи применяются
+        по одной, чтобы одна испорченная запись не задерживала остальные.
+        Запись, которая не применилась WRITE_BEHIND_MAX_DELIVERIES раз, отбрасывается
+    '''
+    try:
+        applied = await apply_entries(entries)
+        logger.info(f'Сброшено записей: {len(entries)}, применено уроков: {applied}')
+        return
+    except Exception as e:
+        if len(entries) == 1:
+            failed = entries
+        else:
+            logger.error(f'Ошибка при сбросе пачки записей, записи применяются по одной: {e}')
+            failed = []
+            for entry in entries:
+                try:
+                    await apply_entries([entry])
+                except Exception as entry_error:
+                    logger.error(f'Ошибка при сбросе записи {entry[0]}: {entry_error}')
+                    failed.append(entry)
+    if not failed:
+        return
+
+    pending = await redis_client.xpending_range(
+        LESSONS_STREAM, LESSONS_GROUP, min=failed[0][0], max=failed[-1][0], count=len(entries)
+    )
+    deliveries = {item['message_id']: item['times_delivered'] for item in pending}
+    retry = []
+    for entry_id, fields in failed:
+        if deliveries.get(entry_id, 0) >= WRITE_BEHIND_MAX_DELIVERIES:
+            await dead_letter(entry_id, fields)
+        else:
+            retry.append(entry_id)
+    if retry:
+        # оставшиеся записи не подтверждены и будут прочитаны повторно из своего списка ожидания
+        raise RuntimeError(f'Не удалось сбросить записи: {", ".join(retry)}')
+
+
+async def read_own_pending(consumer: str) -> list[tuple[str, dict]]:
+    '''
+        Чтение неподтверждённых записей этого обработчика, включая забранные у упавших
+    '''
+    response = await redis_client.xreadgroup(LESSONS_GROUP, consumer, {LESSONS_STREAM: '0'}, count=WRITE_BEHIND_BATCH)
+    entries = response[0][1] if response else []
+    # удалённые из потока записи приходят без полей, их остаётся только подтвердить
+    deleted = [entry_id for entry_id, fields in entries if not fields]
+    if deleted:
+        await redis_client.xack(LESSONS_STREAM, LESSONS_GROUP, *deleted)
+    return [(entry_id, fields) for entry_id, fields in entries if fields]
+
+
+async def read_new(consumer: str) -> list[tuple[str, dict]]:
+    response = await redis_client.xreadgroup(
+        LESSONS_GROUP, consumer, {LESSONS_STREAM: '>'}, count=WRITE_BEHIND_BATCH, block=WRITE_BEHIND_BLOCK_MS
+    )
+    return response[0][1] if response else []
+
+
+async def run_worker(consumer: str):
+    '''
+        Обработчик группы потребителей: читает поток пачками и сбрасывает их в базу
+    '''
+    try:
+        await redis_client.xgroup_create(LESSONS_STREAM, LESSONS_GROUP, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+    # после перезапуска в списке ожидания могут остаться записи этого же обработчика
+    retry_own = True
+    last_claim = 0.0
+    while True:
+        try:
+            # записи упавших обработчиков забираются себе и обрабатываются как свои неподтверждённые
+            if time.monotonic() - last_claim >= WRITE_BEHIND_CLAIM_IDLE_MS / 1000:
+                claimed = await redis_client.xautoclaim(
+                    LESSONS_STREAM, LESSONS_GROUP, consumer, WRITE_BEHIND_CLAIM_IDLE_MS, count=WRITE_BEHIND_BATCH, justid=True
+                )
+                retry_own = retry_own or bool(claimed)
+                last_claim = time.monotonic()
+
+            entries = []
+            if retry_own:
+                entries = await read_own_pending(consumer)
+                retry_own = bool(entries)
+            if not entries:
+                entries = await read_new(consumer)
+            if not entries:
+                continue
+            await flush(entries)
+        except RedisError as e:
+            logger.error(f'Ошибка Redis в обработчике записей: {e}')
+            retry_own = True
+            await asyncio.sleep(1)
+        except Exception as e:
+            logger.error(f'Ошибка при сбросе записей в базу: {e}')
+            retry_own = True
+            await asyncio.sleep(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(run_worker(os.getenv('WRITE_BEHIND_CONSUMER', socket.gethostname())))
@@ -0,0 +1,109 @@
+'''
+    Подсчёт команд Redis на диалогах бота (регистрация и ввод баллов)
+    для стандартного RedisStorage и PipelinedRedisStorage.
+    Команды считаются на стороне сервера через INFO commandstats,
+    поэтому скрипт нужно запускать на отдельной базе Redis без другой нагрузки.
+
+    Запуск:
+        REDIS_URL=redis://localhost:6379/15 python benchmarks/fsm_storage_commands.py
+'''
+import os
+import sys
+import asyncio
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'telegram'))
+from storage import FSMFlushMiddleware, FSMScopeMiddleware, PipelinedRedisStorage  # noqa: E402
+
+
+KEY = StorageKey(bot_id=1, chat_id=1, user_id=1)
+
+
+async def register(state: FSMContext):
+    await state.set_state('RegistrationStates:waiting_for_name')
+    await state.update_data(user_id=KEY.user_id)
+
+
+async def process_name(state: FSMContext):
+    await state.update_data(name='Иван')
+    await state.set_state('RegistrationStates:waiting_for_surname')
+
+
+async def process_surname(state: FSMContext):
+    data = await state.get_data()
+    assert data == {'user_id': KEY.user_id, 'name': 'Иван'}, data
+    await state.clear()
+
+
+async def enter_scores_callback(state: FSMContext):
+    await state.set_state('LessonStates:lesson_adding')
+    await state.update_data(user_id=KEY.user_id)
+    await state.update_data(lesson_id=1)
+
+
+async def process_lesson(state: FSMContext):
+    data = await state.get_data()
+    assert data == {'user_id': KEY.user_id, 'lesson_id': 1}, data
+    await state.clear()
+
+
+FLOWS = {
+    'Регистрация': [register, process_name, process_surname],
+    'Изменение баллов': [enter_scores_callback, process_lesson],
+}
+
+
+async def handle(storage: RedisStorage, handler):
+    '''
+        Обработка одного обновления так же, как в диспетчере: FSMContextMiddleware
+        читает состояние перед фильтрами, затем вызывается обработчик
+    '''
+    state = FSMContext(storage=storage, key=KEY)
+    pipelined = isinstance(storage, PipelinedRedisStorage)
+
+    async def run_handler(event, data):
+        await handler(state)
+
+    async def run(event, data):
+        await state.get_state()
+        if pipelined:
+            return await FSMFlushMiddleware(storage)(run_handler, event, data)
+        return await run_handler(event, data)
+
+    if pipelined:
+        return await FSMScopeMiddleware(storage)(run, None, {})
+    return await run(None, {})
+
+
+async def count_commands(storage: RedisStorage, handlers) -> tuple[int, dict[str, int]]:
+    await storage.redis.config_resetstat()
+    for handler in handlers:
+        await handle(storage, handler)
+    stats = await storage.redis.info('commandstats')
+    # служебные команды самого замера не учитываются
+    commands = {
+        name.removeprefix('cmdstat_'): value['calls']
+        for name, value in stats.items()
+        if name not in ('cmdstat_config|resetstat', 'cmdstat_config', 'cmdstat_info')
+    }
+    return sum(commands.values()), commands
+
+
+async def main():
+    url = os.getenv('REDIS_URL', 'redis://localhost:6379/15')
+    for storage_class in (RedisStorage, PipelinedRedisStorage):
+        storage = storage_class.from_url(url, state_ttl=60, data_ttl=60)
+        try:
+            for flow, handlers in FLOWS.items():
+                total, commands = await count_commands(storage, handlers)
+                details = ', '.join(f'{name}={calls}' for name, calls in sorted(commands.items()))
+                print(f'{storage_class.__name__:<24} {flow:<18} команд: {total:<3} ({details})')
+        finally:
+            await storage.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -6,19 +6,28 @@ from random import choice
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
-from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
+from storage import PipelinedRedisStorage, setup_storage
+
 
 logging.basicConfig(level=logging.INFO)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 API_URL = 'http://fastapi:8000'
 
-storage = RedisStorage.from_url(os.getenv('REDIS_URL'))
+# Незавершённые регистрация и ввод баллов удаляются из Redis через FSM_TTL секунд простоя
+FSM_TTL = int(os.getenv('FSM_TTL', '86400'))
+if FSM_TTL <= 0:
+    # SET ... EX 0 Redis отклоняет как ошибку
+    raise ValueError(f'FSM_TTL должен быть положительным, получено {FSM_TTL}')
+
+storage = PipelinedRedisStorage.from_url(os.getenv('REDIS_URL'), state_ttl=FSM_TTL, data_ttl=FSM_TTL)
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=storage)
+# блокировка событий одного пользователя в Redis, чтобы реплики бота не обрабатывали их параллельно
+dp = Dispatcher(storage=storage, events_isolation=storage.create_isolation())
+setup_storage(dp, bot, storage)
 
 
 
@@ -152,6 +161,9 @@ async def enter_scores(message: types.Message):
         text = 'Выберите предмет для изменения или создайте новый:\n'
         for lesson in lessons:
             text += f'\n{lesson['title']}: *{lesson['score']}*'
+            # предмет ещё не сохранён в базу и не имеет id
+            if lesson['id'] is None:
+                continue
             keyboard.append([types.InlineKeyboardButton(text=f'📝 Изменить {lesson['title']}', callback_data=f'edit_{lesson['id']}'),
                              types.InlineKeyboardButton(text=f'🗑️ Удалить {lesson['title']}', callback_data=f'del_{lesson['id']}')])
     else:
@@ -180,7 +192,7 @@ async def enter_scores_callback(callback: types.CallbackQuery, state: FSMContext
         lesson_id = int(callback.data.split('_')[-1])
         try:
             async with aiohttp.ClientSession() as session:
-                async with session.delete(f"{API_URL}/api/lessons/{lesson_id}") as response:
+                async with session.delete(f"{API_URL}/api/lessons/{callback.from_user.id}/{lesson_id}") as response:
                     if response.status == 200:
                         result = await response.json()
                         print(result)
@@ -0,0 +1,182 @@
+from collections.abc import Mapping
+from contextvars import ContextVar
+from typing import Any, cast
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType, StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+
+
+class _Entry:
+    '''
+        Состояние и данные одного ключа FSM внутри обработки события
+    '''
+    __slots__ = ('key', 'state', 'data', 'loaded', 'state_dirty', 'data_dirty')
+
+    def __init__(self, key: StorageKey):
+        self.key = key
+        self.state: str | None = None
+        self.data: dict[str, Any] | None = None
+        self.loaded = False
+        self.state_dirty = False
+        self.data_dirty = False
+
+
+# Кэш ключей FSM текущего события, живёт только пока обрабатывается одно обновление
+_scope: ContextVar[dict[str, _Entry] | None] = ContextVar('fsm_scope', default=None)
+
+
+class PipelinedRedisStorage(RedisStorage):
+    '''
+        Хранилище FSM поверх Redis, которое за время обработки события читает состояние
+        и данные одним MGET, а все изменения отправляет одним pipeline.
+        Изменения сбрасываются перед каждым запросом к Bot API и сразу после обработчика,
+        пока ещё удерживается блокировка событий пользователя (events isolation),
+        поэтому следующее событие того же пользователя читает уже записанное состояние.
+        Вне обработки события методы работают как обычный RedisStorage
+    '''
+
+    def _entry(self, key: StorageKey) -> _Entry | None:
+        scope = _scope.get()
+        if scope is None:
+            return None
+        return scope.setdefault(self.key_builder.build(key), _Entry(key))
+
+    async def _load(self, key: StorageKey, entry: _Entry):
+        state, data = await self.redis.mget(self.key_builder.build(key, 'state'), self.key_builder.build(key, 'data'))
+        if not entry.state_dirty:
+            entry.state = state.decode('utf-8') if isinstance(state, bytes) else state
+        if not entry.data_dirty:
+            entry.data = self.json_loads(data) if data is not None else {}
+        entry.loaded = True
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = self._entry(key)
+        if entry is None:
+            return await super().set_state(key, state)
+        entry.state = cast(str, state.state if isinstance(state, State) else state)
+        entry.state_dirty = True
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        entry = self._entry(key)
+        if entry is None:
+            return await super().get_state(key)
+        if not entry.loaded and not entry.state_dirty:
+            await self._load(key, entry)
+        return entry.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        entry = self._entry(key)
+        if entry is None:
+            return await super().set_data(key, data)
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        entry.data = data.copy()
+        entry.data_dirty = True
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        entry = self._entry(key)
+        if entry is None:
+            return await super().get_data(key)
+        if not entry.loaded and not entry.data_dirty:
+            await self._load(key, entry)
+        return entry.data.copy()
+
+    async def flush(self):
+        '''
+            Запись всех изменённых ключей текущего события одним pipeline.
+            Записываются только изменённые части, у неизменённой продлевается TTL (если он задан),
+            так что брошенные диалоги удаляются целиком, а чужие изменения не затираются
+        '''
+        scope = _scope.get()
+        if not scope:
+            return
+        dirty = [entry for entry in scope.values() if entry.state_dirty or entry.data_dirty]
+        if not dirty:
+            return
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for entry in dirty:
+                state_key = self.key_builder.build(entry.key, 'state')
+                data_key = self.key_builder.build(entry.key, 'data')
+                if entry.state_dirty:
+                    if entry.state is None:
+                        pipe.delete(state_key)
+                    else:
+                        pipe.set(state_key, entry.state, ex=self.state_ttl)
+                elif self.state_ttl:
+                    pipe.expire(state_key, self.state_ttl)
+                if entry.data_dirty:
+                    if not entry.data:
+                        pipe.delete(data_key)
+                    else:
+                        pipe.set(data_key, self.json_dumps(entry.data), ex=self.data_ttl)
+                elif self.data_ttl:
+                    pipe.expire(data_key, self.data_ttl)
+                entry.state_dirty = entry.data_dirty = False
+            await pipe.execute()
+
+
+class FSMScopeMiddleware(BaseMiddleware):
+    '''
+        Открывает кэш FSM на время обработки обновления. Изменения, сделанные
+        в других внешних middleware, сбрасываются в конце
+    '''
+    def __init__(self, storage: PipelinedRedisStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        token = _scope.set({})
+        try:
+            return await handler(event, data)
+        finally:
+            try:
+                await self.storage.flush()
+            finally:
+                _scope.reset(token)
+
+
+class FSMFlushMiddleware(BaseMiddleware):
+    '''
+        Сбрасывает изменения FSM сразу после обработчика, пока FSMContextMiddleware
+        ещё держит блокировку событий пользователя
+    '''
+    def __init__(self, storage: PipelinedRedisStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            await self.storage.flush()
+
+
+class FSMFlushRequestMiddleware(BaseRequestMiddleware):
+    '''
+        Сбрасывает изменения FSM перед запросом к Bot API, чтобы ответ
+        пользователю не опережал сохранение его состояния
+    '''
+    def __init__(self, storage: PipelinedRedisStorage):
+        self.storage = storage
+
+    async def __call__(self, make_request, bot, method):
+        await self.storage.flush()
+        return await make_request(bot, method)
+
+
+def setup_storage(dp: Dispatcher, bot: Bot, storage: PipelinedRedisStorage):
+    '''
+        Подключение кэша FSM: кэш открывается снаружи FSMContextMiddleware,
+        чтобы чтение состояния перед фильтрами тоже попадало в кэш,
+        а изменения сбрасываются внутри него, под блокировкой событий пользователя
+    '''
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(FSMScopeMiddleware(storage))
+    dp.update.outer_middleware(dp.fsm)
+    dp.update.middleware(FSMFlushMiddleware(storage))
+    bot.session.middleware(FSMFlushRequestMiddleware(storage))
@@ -0,0 +1,274 @@
+'''
+    Проверка PipelinedRedisStorage на диалогах бота (регистрация и изменение баллов):
+    обновления проходят через Dispatcher, настроенный setup_storage, Redis заменён fakeredis
+'''
+import json
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.base import BaseSession
+from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisEventIsolation
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeAsyncRedisConnection, FakeRedis
+
+from storage import PipelinedRedisStorage, setup_storage
+
+
+USER_ID = 1
+BOT_TOKEN = '42:TEST'
+FSM_TTL = 60
+# служебные команды соединения и блокировки событий не относятся к хранилищу FSM
+SERVICE_COMMANDS = {'CLIENT', 'HELLO', 'PING', 'SELECT', 'SCRIPT', 'EVAL', 'EVALSHA'}
+
+# команды Redis, отправленные хранилищем, по одному кортежу на обращение к серверу
+round_trips: list[tuple[str, ...]] = []
+
+
+class CountingConnection(FakeAsyncRedisConnection):
+    '''
+        Соединение fakeredis, которое запоминает команды каждого обращения к серверу
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.packed = []
+
+    def pack_command(self, *args):
+        name = str(args[0]).split()[0].upper()
+        if name not in SERVICE_COMMANDS and not any(str(arg).endswith(':lock') for arg in args):
+            self.packed.append(name)
+        return super().pack_command(*args)
+
+    async def send_packed_command(self, command, check_health=True):
+        if self.packed:
+            round_trips.append(tuple(self.packed))
+            self.packed = []
+        return await super().send_packed_command(command, check_health)
+
+
+class FakeSession(BaseSession):
+    '''
+        Сессия Bot API без сети: запоминает, что лежало в Redis в момент каждого запроса
+    '''
+    def __init__(self, inspect: FakeRedis):
+        super().__init__()
+        self.inspect = inspect
+        self.requests = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append((type(method).__name__, await fsm_snapshot(self.inspect)))
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+class RecordingIsolation(RedisEventIsolation):
+    '''
+        Блокировка событий пользователя, которая запоминает, что лежало в Redis в момент её снятия
+    '''
+    def __init__(self, redis, inspect: FakeRedis):
+        super().__init__(redis=redis)
+        self.inspect = inspect
+        self.released = []
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        async with super().lock(key):
+            yield
+            self.released.append(await fsm_snapshot(self.inspect))
+
+
+class RegistrationStates(StatesGroup):
+    waiting_for_name = State()
+    waiting_for_surname = State()
+
+
+class LessonStates(StatesGroup):
+    lesson_adding = State()
+
+
+async def fsm_snapshot(inspect: FakeRedis) -> tuple[str | None, dict | None]:
+    state, data = await inspect.mget(f'fsm:{USER_ID}:{USER_ID}:state', f'fsm:{USER_ID}:{USER_ID}:data')
+    return state, json.loads(data) if data is not None else None
+
+
+def build(state_ttl: int | None = FSM_TTL, data_ttl: int | None = FSM_TTL):
+    '''
+        Диспетчер с теми же переходами FSM, что и в bot.py, но без запросов к API приложения
+    '''
+    server = FakeServer()
+    inspect = FakeRedis(server=server, decode_responses=True)
+    storage = PipelinedRedisStorage(
+        redis=FakeRedis(server=server, connection_class=CountingConnection),
+        state_ttl=state_ttl,
+        data_ttl=data_ttl,
+    )
+    isolation = RecordingIsolation(storage.redis, inspect)
+    session = FakeSession(inspect)
+    bot = Bot(token=BOT_TOKEN, session=session)
+    dp = Dispatcher(storage=storage, events_isolation=isolation)
+    setup_storage(dp, bot, storage)
+
+    @dp.message(Command('register'))
+    async def register(message: types.Message, state: FSMContext):
+        await state.set_state(RegistrationStates.waiting_for_name)
+        await state.update_data(user_id=message.from_user.id)
+        await message.answer('Отлично! Для начала, отправьте Ваше имя')
+
+    @dp.message(Command('rename'))
+    async def rename(message: types.Message, state: FSMContext):
+        # меняется только состояние, данные остаются прежними
+        await state.set_state(RegistrationStates.waiting_for_name)
+
+    @dp.message(RegistrationStates.waiting_for_name)
+    async def process_name(message: types.Message, state: FSMContext):
+        await state.update_data(name=message.text.strip())
+        await state.set_state(RegistrationStates.waiting_for_surname)
+        await message.answer('Теперь отправьте вашу фамилию')
+
+    @dp.message(RegistrationStates.waiting_for_surname)
+    async def process_surname(message: types.Message, state: FSMContext):
+        data = await state.get_data()
+        try:
+            await message.answer(f'{data["name"]} {message.text.strip()} успешно зарегистрирован(а)!')
+        finally:
+            await state.clear()
+
+    @dp.callback_query(F.data.startswith('edit_'))
+    async def enter_scores_callback(callback: types.CallbackQuery, state: FSMContext):
+        await state.set_state(LessonStates.lesson_adding)
+        await state.update_data(user_id=callback.from_user.id)
+        await state.update_data(lesson_id=int(callback.data.split('_')[-1]))
+        await callback.message.edit_text('Отправьте ваши баллы в формате: `Название предмета = 100`')
+
+    @dp.message(LessonStates.lesson_adding)
+    async def process_lesson(message: types.Message, state: FSMContext):
+        data = await state.get_data()
+        try:
+            await message.answer(f'Предмет {data["lesson_id"]} изменён!')
+        finally:
+            await state.clear()
+
+    return dp, bot, storage, inspect, isolation, session
+
+
+def message_update(update_id: int, text: str) -> types.Update:
+    return types.Update(
+        update_id=update_id,
+        message=types.Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=types.Chat(id=USER_ID, type='private'),
+            from_user=types.User(id=USER_ID, is_bot=False, first_name='Иван'),
+            text=text,
+        ),
+    )
+
+
+def callback_update(update_id: int, data: str) -> types.Update:
+    return types.Update(
+        update_id=update_id,
+        callback_query=types.CallbackQuery(
+            id=str(update_id),
+            from_user=types.User(id=USER_ID, is_bot=False, first_name='Иван'),
+            chat_instance='1',
+            data=data,
+            message=message_update(update_id, 'Выберите предмет для изменения').message,
+        ),
+    )
+
+
+async def feed(dp: Dispatcher, bot: Bot, updates: list[types.Update]) -> list[tuple[str, ...]]:
+    round_trips.clear()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return round_trips.copy()
+
+
+READ = ('MGET',)
+WRITE_BOTH = ('MULTI', 'SET', 'SET', 'EXEC')
+CLEAR = ('MULTI', 'DEL', 'DEL', 'EXEC')
+
+
+def test_registration_flow():
+    async def main():
+        dp, bot, storage, inspect, isolation, session = build()
+        commands = await feed(dp, bot, [
+            message_update(1, '/register'),
+            message_update(2, 'Иван'),
+            message_update(3, 'Иванов'),
+        ])
+
+        # одно чтение и одна запись на обновление, изменения отправляются до ответа пользователю
+        assert commands == [READ, WRITE_BOTH, READ, WRITE_BOTH, READ, CLEAR]
+        assert [name for name, _ in session.requests] == ['SendMessage'] * 3
+        assert session.requests[0][1] == ('RegistrationStates:waiting_for_name', {'user_id': 1})
+        assert session.requests[1][1] == ('RegistrationStates:waiting_for_surname', {'user_id': 1, 'name': 'Иван'})
+
+        # state.clear() записан до снятия блокировки событий пользователя
+        assert isolation.released[-1] == (None, None)
+        await storage.close()
+
+    asyncio.run(main())
+
+
+def test_score_edit_flow():
+    async def main():
+        dp, bot, storage, inspect, isolation, session = build()
+        commands = await feed(dp, bot, [
+            callback_update(1, 'edit_5'),
+            message_update(2, 'Математика = 90'),
+        ])
+
+        # три изменения FSM в обработчике кнопки уходят одним pipeline
+        assert commands == [READ, WRITE_BOTH, READ, CLEAR]
+        assert session.requests[0] == ('EditMessageText', ('LessonStates:lesson_adding', {'user_id': 1, 'lesson_id': 5}))
+        assert isolation.released == [
+            ('LessonStates:lesson_adding', {'user_id': 1, 'lesson_id': 5}),
+            (None, None),
+        ]
+        await storage.close()
+
+    asyncio.run(main())
+
+
+def test_ttl_is_set_and_refreshed():
+    async def main():
+        dp, bot, storage, inspect, isolation, session = build()
+        await feed(dp, bot, [message_update(1, '/register')])
+        state_key, data_key = f'fsm:{USER_ID}:{USER_ID}:state', f'fsm:{USER_ID}:{USER_ID}:data'
+        assert 0 < await inspect.ttl(state_key) <= FSM_TTL
+        assert 0 < await inspect.ttl(data_key) <= FSM_TTL
+
+        # при изменении только состояния TTL данных продлевается тем же pipeline
+        await inspect.expire(data_key, 5)
+        commands = await feed(dp, bot, [message_update(2, '/rename')])
+        assert commands == [READ, ('MULTI', 'SET', 'EXPIRE', 'EXEC')]
+        assert 5 < await inspect.ttl(data_key) <= FSM_TTL
+        await storage.close()
+
+    asyncio.run(main())
+
+
+def test_partial_change_without_ttl():
+    async def main():
+        dp, bot, storage, inspect, isolation, session = build(state_ttl=None, data_ttl=None)
+        await feed(dp, bot, [message_update(1, '/register')])
+
+        # без TTL неизменённая часть не трогается, а ключи хранятся бессрочно
+        commands = await feed(dp, bot, [message_update(2, '/rename')])
+        assert commands == [READ, ('MULTI', 'SET', 'EXEC')]
+        assert await inspect.ttl(f'fsm:{USER_ID}:{USER_ID}:state') == -1
+        assert await inspect.ttl(f'fsm:{USER_ID}:{USER_ID}:data') == -1
+        await storage.close()
+
+    asyncio.run(main())